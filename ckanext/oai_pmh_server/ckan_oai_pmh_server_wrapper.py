@@ -53,12 +53,16 @@ class CKANOAIPMHServerWrapper:
         else:
             self.resumption_validity = resumption_validity
 
+        self.resumption_batch_size = resumption_batch_size
         self.server = oaisrv.BatchingServer(
             client,
             metadata_registry=metadata_registry,
             resumption_batch_size=resumption_batch_size,
         )
         self.params = {}
+        # Number of records, headers or sets in the last response, used to
+        # weight rate limiting by the work done
+        self.records_served = 1
 
     # Requires Pylons params
     def handleRequest(self, params):
@@ -146,6 +150,9 @@ class CKANOAIPMHServerWrapper:
             nt = qsToSingleDict(e_nt[0].text)
 
         e_verb.remove(e_added)
+        self.records_served = sum(
+            1 for e in e_verb if e.tag != oaisrv.nsoai("resumptionToken")
+        )
 
         # Retrieve resumptionToken
         e_resumptionToken = e_verb.find(oaisrv.nsoai("resumptionToken"))
@@ -155,6 +162,13 @@ class CKANOAIPMHServerWrapper:
             # https://stackoverflow.com/a/26853961/422680
             token = {**token, **nt}
 
+            # pyoai moves the cursor by the configured batch size, count the
+            # records actually served instead
+            cursor = min(
+                cursor - self.resumption_batch_size + self.records_served,
+                int(token["completeListSize"]),
+            )
+
             # Add expirationDate to resumptionToken
             # Decide wether to use ISO8601 or timestamp
             if self.resumption_validity > 0:
@@ -167,7 +181,10 @@ class CKANOAIPMHServerWrapper:
             e_new_resumptionToken = etree.Element(
                 oaisrv.nsoai("resumptionToken")
             )
-            e_new_resumptionToken.text = new_resumptionToken
+            # Datasets are listed from a position: without one, this page
+            # completes the list and gets an empty resumptionToken
+            if "after" in nt or e_verb.tag == oaisrv.nsoai("ListSets"):
+                e_new_resumptionToken.text = new_resumptionToken
             e_new_resumptionToken.attrib['cursor'] = str(cursor).encode('utf-8')
             e_new_resumptionToken.attrib['completeListSize'] = token['completeListSize']
             e_verb.replace(e_resumptionToken, e_new_resumptionToken)
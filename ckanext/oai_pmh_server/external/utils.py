@@ -1,8 +1,26 @@
+from types import MappingProxyType
+
 from iso639 import languages
 
 import ckan.model as model
 
 
+def _build_language_table():
+    """
+    Map alpha2 (eg. 'en') and alpha3 bibliographic (eg. 'ger') codes to the
+    terminology code (eg. 'eng', 'deu'). Alpha2 codes take precedence.
+    """
+
+    table = {code: lang.terminology for code, lang in languages.part2b.items()}
+    table.update(
+        (code, lang.terminology) for code, lang in languages.part1.items()
+    )
+    return MappingProxyType(table)
+
+
+LANGUAGE_TABLE = _build_language_table()
+
+
 def convert_language(lang):
     """
     Convert alpha2 language (eg. 'en') to terminology language (eg. 'eng')
@@ -10,16 +28,15 @@ def convert_language(lang):
 
     if not lang:
         return "und"
+    return LANGUAGE_TABLE.get(lang, "")
 
-    try:
-        lang_object = languages.get(part1=lang)
-        return lang_object.terminology
-    except KeyError as ke:
-        try:
-            lang_object = languages.get(part2b=lang)
-            return lang_object.terminology
-        except KeyError as ke:
-            return ""
+
+def convert_languages(langs):
+    """
+    Convert a list of alpha2 languages to terminology languages
+    """
+
+    return [convert_language(lang) for lang in langs]
 
 
 def get_earliest_datestamp():
@@ -28,8 +45,17 @@ def get_earliest_datestamp():
     http://www.openarchives.org/OAI/openarchivesprotocol.html#Identify
     """
 
-    return (
+    return get_datestamp(
         model.Session.query(model.Package.metadata_modified)
         .order_by(model.Package.metadata_modified)
         .first()[0]
     )
+
+
+def get_datestamp(modified):
+    """
+    Return the datestamp of a record (its metadata_modified) with the
+    granularity declared in Identify (YYYY-MM-DDThh:mm:ssZ)
+    """
+
+    return modified.replace(microsecond=0)
@@ -1,4 +1,4 @@
-from ckanext.dcat.processors import RDFSerializer
+from functools import lru_cache, partial
 
 from .external.rdftools import rdf_reader, dcat2rdf_writer
 
@@ -48,3 +48,22 @@ for prefix in availableMetadataPrefix:
         availableMetadataPrefix[prefix]["namespace"],
     )
     metadataFormats.append(metadataFormat)
+
+
+@lru_cache(maxsize=None)
+def get_rdf_serializer(prefix):
+    """Return a factory of RDF serializers for the given metadataPrefix.
+
+    ckanext-dcat (and rdflib) and the profiles of each prefix are only
+    imported on the first request that uses that prefix, so CKAN workers that
+    never serve /oai do not pay for them.
+    """
+
+    from ckanext.dcat.processors import RDFSerializer
+
+    profiles = availableMetadataPrefix[prefix].get("profiles")
+    # Loads the profile plugins once, and fails early if one is missing
+    RDFSerializer(profiles)
+    # A new serializer is still needed for every dataset, to start from an
+    # empty graph
+    return partial(RDFSerializer, profiles)
@@ -0,0 +1,206 @@
+"""Batched Dublin Core (oai_dc) record builder.
+
+A whole page of datasets is fetched with a single ``package_search`` call and
+mapped to Dublin Core field lists in one pass, using field extractors that are
+built once per dataset type. Search results whose ``metadata_modified`` differs
+from the database row (index not updated yet) are replaced by ``package_show``,
+so a record never lags behind its header datestamp.
+"""
+
+import json
+from functools import lru_cache
+
+from oaipmh import common
+
+from ckan.logic import get_action
+from ckan.plugins.toolkit import config
+from ckan.lib.helpers import url_for
+
+import ckanext.oai_pmh_server.external.utils as utils
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def get_json_content(value):
+    """
+    Gets all items from a JSON object string (e.g. translated titles)
+    :param value: json string or plain text
+    :return: list of items
+    """
+
+    if isinstance(value, str) and value.startswith("{"):
+        try:
+            json_data = json.loads(value)
+        except ValueError:
+            return [value]
+        if isinstance(json_data, dict):
+            return list(json_data.values())
+    return [value]
+
+
+def _agents_by_role(package):
+    """Group the agents of a package by role in a single pass."""
+    agents = {}
+    for agent in package.get("agent") or []:
+        if "name" in agent:
+            agents.setdefault(agent.get("role"), []).append(agent["name"])
+    return agents
+
+
+def _split(value):
+    if isinstance(value, str):
+        return [v.strip() for v in value.split(",")]
+    return list(value)
+
+
+def _coverage(package, agents):
+    coverage = []
+    geographic = package.get("geographic_coverage", "")
+    if geographic:
+        coverage.extend(geographic.split(","))
+    temporal_begin = package.get("temporal_coverage_begin", "")
+    temporal_end = package.get("temporal_coverage_end", "")
+    if temporal_begin or temporal_end:
+        coverage.append("%s/%s" % (temporal_begin, temporal_end))
+    return coverage or None
+
+
+@lru_cache(maxsize=None)
+def _field_extractors(dataset_type):
+    """Return the (field, extractor) pairs for a dataset type.
+
+    Built once per type: the dataset page URL is resolved here, so building a
+    record does not go through Flask routing.
+    """
+
+    read_url = config.get("ckan.site_url") + url_for(
+        "{}.read".format(dataset_type), id="__oai_dc_id__"
+    )
+
+    def identifier(package, agents):
+        pids = [
+            pid.get("id")
+            for pid in package.get("pids") or []
+            if pid.get("id", False)
+        ]
+        pids.append(package.get("id"))
+        pids.append(read_url.replace("__oai_dc_id__", package["name"]))
+        return pids
+
+    return (
+        (
+            "title",
+            lambda p, a: get_json_content(p.get("title") or p.get("name")),
+        ),
+        ("creator", lambda p, a: a.get("author", [])),
+        (
+            "publisher",
+            lambda p, a: a.get("distributor", [])
+            + [c["name"] for c in p.get("contact") or [] if "name" in c],
+        ),
+        ("contributor", lambda p, a: a.get("contributor", [])),
+        ("identifier", identifier),
+        ("type", lambda p, a: ["dataset"]),
+        (
+            "language",
+            lambda p, a: _split(p["language"]) if p.get("language") else None,
+        ),
+        (
+            "description",
+            lambda p, a: get_json_content(p["notes"]) if p.get("notes") else None,
+        ),
+        (
+            "subject",
+            lambda p, a: [tag.get("display_name") for tag in p["tags"]]
+            if p.get("tags")
+            else None,
+        ),
+        (
+            "date",
+            lambda p, a: [p["metadata_created"][:10]]
+            if p.get("metadata_created")
+            else None,
+        ),
+        (
+            "rights",
+            lambda p, a: [p["license_title"]] if p.get("license_title") else None,
+        ),
+        ("coverage", _coverage),
+    )
+
+
+def dublin_core(package):
+    """Map a package dict to a dictionary of Dublin Core field lists."""
+
+    agents = _agents_by_role(package)
+    metadata = {
+        str(extra["key"]): [extra["value"]]
+        for extra in package.get("extras") or []
+    }
+    for field, extract in _field_extractors(package.get("type") or "dataset"):
+        value = extract(package, agents)
+        if value is None:
+            continue
+        # Fixes the bug on having a large dataset being scrambled to
+        # individual letters
+        metadata[field] = value if isinstance(value, list) else [value]
+    return metadata
+
+
+def package_dicts(datasets):
+    """Fetch the package dicts of ``datasets`` with as few calls as possible.
+
+    :param datasets: list of Package objects
+    :return: dict of package dicts by id
+    """
+
+    if not datasets:
+        return {}
+    modified = {
+        dataset.id: dataset.metadata_modified.isoformat() for dataset in datasets
+    }
+    result = get_action("package_search")(
+        {},
+        {
+            "fq": "+id:(%s)" % " OR ".join('"%s"' % id for id in modified),
+            "rows": len(modified),
+        },
+    )
+    packages = {
+        package["id"]: package
+        for package in result["results"]
+        if package.get("metadata_modified") == modified.get(package["id"])
+    }
+
+    # Datasets not (yet) in the search index, or indexed before their last
+    # change
+    for id in modified:
+        if id not in packages:
+            packages[id] = get_action("package_show")({}, {"id": id})
+    return packages
+
+
+def records_for_datasets(datasets):
+    """Build oai_dc records for a page of datasets.
+
+    :param datasets: list of (Package, setSpec) tuples
+    :return: list of (Header, Metadata, None) tuples
+    """
+
+    packages = package_dicts([dataset for dataset, _ in datasets])
+    return [
+        (
+            common.Header(
+                "",
+                dataset.id,
+                utils.get_datestamp(dataset.metadata_modified),
+                [spec],
+                False,
+            ),
+            common.Metadata("", dublin_core(packages[dataset.id])),
+            None,
+        )
+        for dataset, spec in datasets
+    ]
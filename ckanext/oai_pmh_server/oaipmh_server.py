@@ -1,37 +1,36 @@
 # https://github.com/kangmoesss/ckanext-oaipmh-1/blob/55d1b73fe7da710410bf361d1e1d8b777b15a82a/ckanext/oaipmh/oaipmh_server.py
 
-import json
-from datetime import datetime
+from datetime import datetime, timedelta
 from lxml import etree
 from urllib.parse import urlencode, quote
 
 from oaipmh import common
 from oaipmh.common import ResumptionOAIPMH
-from oaipmh.error import IdDoesNotExistError
+from oaipmh.error import (
+    BadResumptionTokenError,
+    IdDoesNotExistError,
+    NoRecordsMatchError,
+)
 
 from ckan.logic import get_action
-from ckan.model import Package, Session, Group
+from ckan.model import Package, Session, Group, Member
 from ckan.plugins.toolkit import config
 from ckan.lib.helpers import url_for
 
-from sqlalchemy import between
+from sqlalchemy import func, literal, tuple_
 
-import ckanext.oai_pmh_server.external.helpers as helpers
 import ckanext.oai_pmh_server.external.utils as utils
 
-from ckanext.dcat.processors import RDFSerializer
-
 import ckanext.oai_pmh_server.plugin as internal_plugin
 from .metadata_registry import availableMetadataPrefix, metadataFormats
+from .set_catalog import set_catalog
+from . import oai_dc, record_cache
 
 import logging
 
 log = logging.getLogger(__name__)
 
 
-default_rdfserializer = RDFSerializer()
-
-
 class CKANServer(ResumptionOAIPMH):
     """A OAI-PMH implementation class for CKAN."""
 
@@ -52,24 +51,8 @@ class CKANServer(ResumptionOAIPMH):
             compression=["identity"],
         )
 
-    def _get_json_content(self, js):
-        """
-        Gets all items from JSON
-        :param js: json string
-        :return: list of items
-        """
-
-        try:
-            json_data = json.loads(js)
-            json_titles = list()
-            for key, value in json_data.iteritems():
-                json_titles.append(value)
-            return json_titles
-        except:
-            return [js]
-
     def _record_for_dataset_dcat(
-        self, dataset, spec, profiles=None, compatibility_mode=False
+        self, dataset, spec, metadataPrefix, compatibility_mode=False
     ):
         """Show a tuple of a header and metadata for this dataset.
         Note that dataset_xml (metadata) returned is just a string containing
@@ -77,15 +60,31 @@ class CKANServer(ResumptionOAIPMH):
         getRecord method.
         """
 
-        package = get_action("package_show")({}, {"id": dataset.id})
-        # We need to create a new RDF serializer every time, in order to
-        # reset the internal graph. Otherwise, using always the same instance,
-        # objects will be appended
-        rdfserializer = RDFSerializer(profiles, compatibility_mode)
-        dataset_xml = rdfserializer.serialize_dataset(package, _format="xml")
+        # Records rendered in the background after the last dataset change
+        dataset_xml = None
+        if not compatibility_mode:
+            dataset_xml = record_cache.get_record(
+                metadataPrefix, dataset.id, dataset.metadata_modified
+            )
+        if dataset_xml is None:
+            package = get_action("package_show")({}, {"id": dataset.id})
+            dataset_xml = record_cache.render_xml(
+                package, metadataPrefix, compatibility_mode
+            )
+            if not compatibility_mode:
+                record_cache.store_record(
+                    metadataPrefix,
+                    dataset.id,
+                    dataset.metadata_modified,
+                    dataset_xml,
+                )
         return (
             common.Header(
-                "", dataset.id, dataset.metadata_created, [spec], False
+                "",
+                dataset.id,
+                utils.get_datestamp(dataset.metadata_modified),
+                [spec],
+                False,
             ),
             dataset_xml,
             None,
@@ -95,155 +94,69 @@ class CKANServer(ResumptionOAIPMH):
 
     def _record_for_dataset(self, dataset, spec):
         """Show a tuple of a header and metadata for this dataset."""
-        package = get_action("package_show")({}, {"id": dataset.id})
-
-        coverage = []
-        temporal_begin = package.get("temporal_coverage_begin", "")
-        temporal_end = package.get("temporal_coverage_end", "")
-
-        geographic = package.get("geographic_coverage", "")
-        if geographic:
-            coverage.extend(geographic.split(","))
-        if temporal_begin or temporal_end:
-            coverage.append("%s/%s" % (temporal_begin, temporal_end))
-
-        pids = [
-            pid.get("id")
-            for pid in package.get("pids", {})
-            if pid.get("id", False)
-        ]
-        pids.append(package.get("id"))
-        pids.append(
-            config.get("ckan.site_url")
-            + url_for(controller="package", action="read", id=package["name"])
-        )
-
-        meta = {
-            "title": self._get_json_content(
-                package.get("title", None) or package.get("name")
-            ),
-            "creator": [
-                author["name"]
-                for author in helpers.get_authors(package)
-                if "name" in author
-            ],
-            "publisher": [
-                agent["name"]
-                for agent in helpers.get_distributors(package)
-                + helpers.get_contacts(package)
-                if "name" in agent
-            ],
-            "contributor": [
-                author["name"]
-                for author in helpers.get_contributors(package)
-                if "name" in author
-            ],
-            "identifier": pids,
-            "type": ["dataset"],
-            "language": [l.strip() for l in package.get("language").split(",")]
-            if package.get("language", None)
-            else None,
-            "description": self._get_json_content(package.get("notes"))
-            if package.get("notes", None)
-            else None,
-            "subject": [tag.get("display_name") for tag in package["tags"]]
-            if package.get("tags", None)
-            else None,
-            "date": [dataset.metadata_created.strftime("%Y-%m-%d")]
-            if dataset.metadata_created
-            else None,
-            "rights": [package["license_title"]]
-            if package.get("license_title", None)
-            else None,
-            "coverage": coverage if coverage else None,
-        }
-
-        iters = dataset.extras.items()
-        meta = dict(iters + meta.items())
-        metadata = {}
-        # Fixes the bug on having a large dataset being scrambled to individual
-        # letters
-        for key, value in meta.items():
-            if not isinstance(value, list):
-                metadata[str(key)] = [value]
-            else:
-                metadata[str(key)] = value
-        return (
-            common.Header(
-                "", dataset.id, dataset.metadata_created, [spec], False
-            ),
-            common.Metadata("", metadata),
-            None,
-        )
+        return oai_dc.records_for_datasets([(dataset, spec)])[0]
 
     @staticmethod
-    def _filter_packages(set, cursor, from_, until, batch_size):
-        """Get a part of datasets for "listNN" verbs."""
+    def _dataset_query(set, from_, until, *columns):
+        """Query ``columns`` and the setSpec of the datasets to list.
+
+        The setSpec is the requested set or, without set, the owner
+        organization name (the dataset name for datasets without one).
+        """
 
-        packages = []
-        group = None
         if not set:
-            packages = (
-                Session.query(Package)
-                .filter(Package.type == "dataset")
-                .filter(Package.state == "active")
+            query = (
+                Session.query(*columns, func.coalesce(Group.name, Package.name))
+                .outerjoin(Group, Group.id == Package.owner_org)
                 .filter(Package.private != True)
             )
-            # https://github.com/ckan/ckan/blob/f58c0bcaea2184e18f2bed327873ba38c9bcbfe7/ckan/migration/revision_legacy_code.py
-            # It seems that you have to use RevisionTableMappings.instance() L42
-            # Another option is using the metadata_modified attribute
-            if from_ and not until:
-                packages = packages.filter(Package.metadata_modified > from_)
-            if until and not from_:
-                packages = packages.filter(Package.metadata_modified < until)
-            if from_ and until:
-                packages = packages.filter(
-                    between(Package.metadata_modified, from_, until)
-                )
-            # packages = packages.order_by(Package.metadata_modified)
-            packages = packages.all()
         else:
-            group = Group.get(set)
-            if group:
-                # Note that group.packages never returns private datasets regardless of 'with_private' parameter.
-                packages = (
-                    group.packages(return_query=True, with_private=False)
-                    .filter(Package.type == "dataset")
-                    .filter(Package.state == "active")
-                )
-                if from_ and not until:
-                    packages = packages.filter(
-                        Package.metadata_modified > from_
-                    )
-                if until and not from_:
-                    packages = packages.filter(
-                        Package.metadata_modified < until
-                    )
-                if from_ and until:
-                    packages = packages.filter(
-                        between(Package.metadata_modified, from_, until)
-                    )
-                # packages = packages.order_by(Package.metadata_modified)
-                packages = packages.all()
-
-        total_len = len(packages)
-        if cursor is not None:
-            cursor_end = (
-                cursor + batch_size
-                if cursor + batch_size < total_len
-                else total_len
+            group = _get_set(set)
+            query = _filter_set(
+                Session.query(*columns, literal(group.name)), group
             )
-            packages = packages[cursor:cursor_end]
-            
-            # Issue with total_len when its multiple of batch_size not returning last package (and and doubling it when batch_size has a difference of +2 with total_len)
-            # Workaround: add an extra package only if original_batch_size (= batch_size-1) is equal to the length of packages left
-                        # at some point in the code, after inserting a header package, the last package is removed
-                        # [internalHeader_package, ..., package(i-1), package(i)] --> [internalHeader_package, ..., package(i-1)], so package(i) is lost
-            original_batch_size = batch_size - 1 # For coding purposes, the batch_size adds up one unit to value set in the configuration (.env)
-            if original_batch_size ==  len(packages):
-                packages.append(packages[-1])
-
-        return packages, group, total_len
+        query = query.filter(Package.type == "dataset").filter(
+            Package.state == "active"
+        )
+        return _filter_dates(query, from_, until)
+
+    @staticmethod
+    def _filter_packages(set, cursor, from_, until, batch_size, after=None):
+        """Get a part of datasets for "listNN" verbs.
+
+        :return: list of (Package, setSpec) tuples, the total count and the
+            position to resume from
+        """
+
+        query = CKANServer._dataset_query(set, from_, until, Package)
+        return _page(
+            query,
+            cursor,
+            batch_size,
+            after,
+            lambda row: (row[0].metadata_modified, row[0].id),
+        )
+
+    @staticmethod
+    def _filter_headers(set, cursor, from_, until, batch_size, after=None):
+        """Get a part of dataset headers for "ListIdentifiers".
+
+        Only the columns needed for a header are selected (no Package entity
+        is loaded) and the page is sliced in the database.
+        """
+
+        query = CKANServer._dataset_query(
+            set, from_, until, Package.id, Package.metadata_modified
+        )
+        rows, total_len, next_after = _page(
+            query, cursor, batch_size, after, lambda row: (row[1], row[0])
+        )
+
+        headers = [
+            common.Header("", id, utils.get_datestamp(modified), [spec], False)
+            for id, modified, spec in rows
+        ]
+        return headers, total_len, next_after
 
     def getRecord(self, metadataPrefix, identifier):
         """Simple getRecord for a dataset."""
@@ -261,7 +174,7 @@ class CKANServer(ResumptionOAIPMH):
             return self._record_for_dataset_dcat(
                 package,
                 spec,
-                availableMetadataPrefix[metadataPrefix].get("profiles"),
+                metadataPrefix,
             )
         return self._record_for_dataset(package, spec)
 
@@ -273,31 +186,17 @@ class CKANServer(ResumptionOAIPMH):
         from_=None,
         until=None,
         batch_size=None,
+        after=None,
     ):
         """List all identifiers for this repository."""
-        data = []
-        packages, group, total_len = self._filter_packages(
-            set, cursor, from_, until, batch_size
+        data, total_len, next_after = self._filter_headers(
+            set, cursor, from_, until, batch_size, after
         )
-        for package in packages:
-            spec = package.name
-            if group:
-                spec = group.name
-            else:
-                if package.owner_org:
-                    group = Group.get(package.owner_org)
-                    if group and group.name:
-                        spec = group.name
-            data.append(
-                common.Header(
-                    "", package.id, package.metadata_created, [spec], False
-                )
-            )
 
         # Create additional header to include extra resumptionToken information
-        data.insert(0, self.generateInternalHeader(total_len))
+        data.insert(0, self.generateInternalHeader(total_len, next_after))
 
-        return data
+        return _add_sentinel(data, batch_size)
 
     def listMetadataFormats(self, identifier=None):
         """List available metadata formats.
@@ -321,58 +220,43 @@ class CKANServer(ResumptionOAIPMH):
         from_=None,
         until=None,
         batch_size=None,
+        after=None,
     ):
         """Show a selection of records, basically lists all datasets."""
         data = []
         # log.info("cursor: %s | batch_size: %s", cursor, batch_size)
-        packages, group, total_len = self._filter_packages(
-            set, cursor, from_, until, batch_size
+        datasets, total_len, next_after = self._filter_packages(
+            set, cursor, from_, until, batch_size, after
         )
-        for package in packages:
-            spec = package.name
-            if group:
-                spec = group.name
-            else:
-                if package.owner_org:
-                    group = Group.get(package.owner_org)
-                    if group and group.name:
-                        spec = group.name
-            if metadataPrefix in availableMetadataPrefix.keys():
+
+        if metadataPrefix in availableMetadataPrefix.keys():
+            for package, spec in datasets:
                 data.append(
                     self._record_for_dataset_dcat(
                         package,
                         spec,
-                        availableMetadataPrefix[metadataPrefix].get("profiles"),
+                        metadataPrefix,
                     )
                 )
-            else:
-                data.append(self._record_for_dataset(package, spec))
-        
+        else:
+            # oai_dc records are built for the whole page at once
+            data.extend(oai_dc.records_for_datasets(datasets))
+
         # Create additional header to include extra resumptionToken information
         data.insert(
             0,
             (
-                self.generateInternalHeader(total_len),
+                self.generateInternalHeader(total_len, next_after),
                 "<empty/>",
                 None,
             ),
         )
-        return data
+        return _add_sentinel(data, batch_size)
 
     def listSets(self, cursor=None, batch_size=None):
         """List all sets in this repository, where sets are groups."""
-        data = []
-        groups = Session.query(Group).filter(Group.state == "active")
-        total_len = groups.count()
-        if cursor is not None:
-            cursor_end = (
-                cursor + batch_size
-                if cursor + batch_size < groups.count()
-                else groups.count()
-            )
-            groups = groups[cursor:cursor_end]
-        for dataset in groups:
-            data.append((dataset.name, dataset.title, dataset.description))
+        groups, total_len = set_catalog.page(cursor, batch_size)
+        data = [(group.name, group.title, group.description) for group in groups]
 
         # Create additional header to include extra resumptionToken information
         tmp = self.generateInternalHeader(total_len)
@@ -380,8 +264,11 @@ class CKANServer(ResumptionOAIPMH):
 
         return data
 
-    def generateInternalHeader(self, total_len):
+    def generateInternalHeader(self, total_len, after=None):
         metadata = {"completeListSize": total_len}
+        if after is not None:
+            # Position of the next page, added to the resumptionToken
+            metadata["after"] = after
         oaipmh_server_extra = quote(urlencode(metadata))
 
         return common.Header(
@@ -391,3 +278,104 @@ class CKANServer(ResumptionOAIPMH):
             [oaipmh_server_extra],
             False,
         )
+
+
+def _get_set(spec):
+    """Resolve a setSpec, rejecting unknown sets before querying packages."""
+
+    group = set_catalog.get(spec)
+    if group is None:
+        raise NoRecordsMatchError("No set %s" % spec)
+    return group
+
+
+def _filter_set(query, group):
+    """Restrict a package query to the public datasets of a set."""
+
+    # Same membership criteria as group.packages()
+    return (
+        query.join(Member, Member.table_id == Package.id)
+        .filter(Member.group_id == group.id)
+        .filter(Member.table_name == "package")
+        .filter(Member.state == "active")
+        .filter(Package.private == False)
+    )
+
+
+def _filter_dates(query, from_, until):
+    """Apply the "from" and "until" selective harvesting arguments.
+
+    Both bounds are inclusive at the declared granularity (seconds), matching
+    the datestamps of the records, which are based on metadata_modified.
+    http://www.openarchives.org/OAI/openarchivesprotocol.html#SelectiveHarvestingandDatestamps
+    """
+
+    if from_:
+        query = query.filter(
+            Package.metadata_modified >= from_.replace(microsecond=0)
+        )
+    if until:
+        # metadata_modified keeps microseconds: include the whole second
+        query = query.filter(
+            Package.metadata_modified
+            < until.replace(microsecond=0) + timedelta(seconds=1)
+        )
+    return query
+
+
+def _page(query, cursor, batch_size, after, key):
+    """Get a page of dataset rows, the total count and the next position.
+
+    Rows are ordered by (metadata_modified, id) and a page starts right after
+    the last row of the previous page, whose position travels in the "after"
+    argument of the resumptionToken. Unlike an offset, this position is not
+    shifted when a dataset is modified during the harvest.
+
+    :param key: function returning the (metadata_modified, id) of a row
+    """
+
+    total_len = query.count()
+    query = query.order_by(Package.metadata_modified, Package.id)
+    if after:
+        query = query.filter(
+            tuple_(Package.metadata_modified, Package.id) > _decode_after(after)
+        )
+    if cursor is None:
+        return query.all(), total_len, None
+
+    # BatchingServer asks for batch_size (configured size + 1) items, the first
+    # one being our internal header. One extra row tells whether there are more.
+    page_size = max(1, batch_size - 1)
+    rows = query.limit(page_size + 1).all()
+    next_after = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_after = _encode_after(*key(rows[-1]))
+    return rows, total_len, next_after
+
+
+def _add_sentinel(data, batch_size):
+    """Let BatchingServer drop an item that is not a record.
+
+    BatchingServer keeps configured size (batch_size - 1) items of a full
+    result, dropping the last one, so a full page (internal header plus
+    configured size records) gets a copy of its last record to be dropped
+    instead. The resumptionToken then added to a page that completes the list
+    is emptied by the wrapper, as no "after" position comes with it.
+    """
+
+    if batch_size is not None and len(data) >= batch_size:
+        data.append(data[-1])
+    return data
+
+
+def _encode_after(modified, id):
+    return "%s,%s" % (modified.isoformat(), id)
+
+
+def _decode_after(after):
+    try:
+        modified, id = after.split(",", 1)
+        return datetime.fromisoformat(modified), id
+    except ValueError:
+        raise BadResumptionTokenError("Invalid position %s" % after)
@@ -1,3 +1,4 @@
+import ckan.model as model
 import ckan.plugins as plugins
 
 # Provides a stable set of classes and functions that plugins can use safe
@@ -6,9 +7,11 @@ import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 from ckan.lib.base import render
 
-from flask import Blueprint, request
+from flask import Blueprint, Response, request
 
-from .ckan_oai_pmh_server_wrapper import CKANOAIPMHServerWrapper
+from . import record_cache, response_cache
+from .rate_limit import client_key, get_rate_limiter
+from .set_catalog import set_catalog
 
 import logging
 
@@ -24,22 +27,88 @@ def oai_action():
     verb = request.args.get("verb", None)
     if verb is None:
         return render("ckanext/oaipmh/oaipmh.html")
-    
+
+    # OAI-PMH allows flow control through 503 + Retry-After
+    # http://www.openarchives.org/OAI/openarchivesprotocol.html#FlowControl
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        client = client_key(request)
+        retry_after = limiter.acquire(client, verb)
+        if retry_after:
+            log.debug("Rate limit exceeded by %s for %s", client, verb)
+            return Response(
+                "Too many requests, retry after %d seconds" % retry_after,
+                status=503,
+                headers={"Retry-After": str(retry_after)},
+                mimetype="text/plain",
+            )
+
+    # Imported here so the OAI-PMH/RDF stack (pyoai, lxml, ckanext-dcat,
+    # rdflib) is only loaded by workers that actually serve /oai
+    from .ckan_oai_pmh_server_wrapper import CKANOAIPMHServerWrapper
+
     # Use of BATCH_SIZE variable for development purposes
     # serv = CKANOAIPMHServerWrapper(resumption_batch_size=BATCH_SIZE) 
     serv = CKANOAIPMHServerWrapper()
-    tmp_response = serv.handleRequest(toolkit.request.args)
-    # log.debug("Response: %s", tmp_response)
 
-    response = serv.handleResponse(tmp_response)
-    # log.debug("Response processed: %s", response)
+    # Identical list requests against an unchanged catalog share the response
+    cache = response_cache.get_response_cache()
+    cache_key = None
+    if cache is not None and verb in response_cache.CACHED_VERBS:
+        try:
+            cache_key = response_cache.request_key(
+                serv.cleanParams(toolkit.request.args)
+            )
+        except Exception:
+            # Invalid arguments are reported by handleRequest below
+            cache_key = None
+    entry = cache.get(cache_key) if cache_key is not None else None
+
+    if entry is not None:
+        records_served = entry.records
+        response = response_cache.make_response(
+            entry, "gzip" in request.accept_encodings
+        )
+    else:
+        tmp_response = serv.handleRequest(toolkit.request.args)
+        # log.debug("Response: %s", tmp_response)
+
+        response = serv.handleResponse(tmp_response)
+        # log.debug("Response processed: %s", response)
+
+        records_served = serv.records_served
+        if cache_key is not None:
+            cache.set(
+                cache_key,
+                response,
+                records_served,
+                response_cache.get_ttl(serv.resumption_validity),
+            )
+
+    if limiter is not None:
+        limiter.charge(client, verb, records_served)
 
     return response
 
 
+def _schedule_render(id):
+    """Render the records of a dataset being saved in the background."""
+    if record_cache.get_backend() is None:
+        return
+    # The hooks run before the commit: pkg_dict holds the submitted data, the
+    # row flushed in this session holds the new metadata_modified
+    package = model.Package.get(id)
+    record_cache.schedule_render(
+        id, package.metadata_modified if package is not None else None
+    )
+
+
 class OaiPmhServerPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
     plugins.implements(plugins.IBlueprint)
+    plugins.implements(plugins.IGroupController, inherit=True)
+    plugins.implements(plugins.IOrganizationController, inherit=True)
+    plugins.implements(plugins.IPackageController, inherit=True)
 
     # IConfigurer
 
@@ -63,3 +132,34 @@ class OaiPmhServerPlugin(plugins.SingletonPlugin):
         )
 
         return blueprint
+
+    # IGroupController, IOrganizationController
+
+    # Sets are groups and organizations: refresh the set catalog when they
+    # change, and the rendered records, which include organization details.
+    # IPackageController calls these methods with datasets too.
+    def create(self, entity):
+        if isinstance(entity, model.Group):
+            set_catalog.invalidate()
+
+    def edit(self, entity):
+        if isinstance(entity, model.Group):
+            set_catalog.invalidate()
+            record_cache.invalidate()
+
+    def delete(self, entity):
+        if isinstance(entity, model.Group):
+            set_catalog.invalidate()
+            record_cache.invalidate()
+
+    # IPackageController
+
+    # Render the OAI-PMH records of changed datasets in the background
+    def after_dataset_create(self, context, pkg_dict):
+        _schedule_render(pkg_dict["id"])
+
+    def after_dataset_update(self, context, pkg_dict):
+        _schedule_render(pkg_dict["id"])
+
+    def after_dataset_delete(self, context, pkg_dict):
+        record_cache.discard(pkg_dict["id"])
@@ -0,0 +1,268 @@
+"""Token-bucket rate limiting for the OAI-PMH route.
+
+Each client (identified by its IP address or User-Agent) gets one bucket per
+OAI-PMH verb. A request is only admitted when its bucket holds at least one
+token; once the response is built, the bucket is charged with the number of
+records served, so expensive ListRecords/ListIdentifiers pages weigh more than
+a single Identify. Buckets may go negative, which makes the client wait until
+the debt is refilled.
+"""
+
+import math
+import threading
+import time
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+RATE_LIMIT_ENABLED_CONFIG_OPTION = "ckanext.oai_pmh_server.rate_limit.enabled"
+DEFAULT_RATE_LIMIT_ENABLED = False
+
+RATE_LIMIT_BACKEND_CONFIG_OPTION = "ckanext.oai_pmh_server.rate_limit.backend"
+DEFAULT_RATE_LIMIT_BACKEND = "memory"  # memory | redis
+
+RATE_LIMIT_KEY_CONFIG_OPTION = "ckanext.oai_pmh_server.rate_limit.key"
+DEFAULT_RATE_LIMIT_KEY = "ip"  # ip | user_agent
+
+# Per verb limit (lowercase verb), given as "<capacity> <period in seconds>",
+# e.g. ckanext.oai_pmh_server.rate_limit.listrecords = 200 60
+RATE_LIMIT_VERB_CONFIG_OPTION = "ckanext.oai_pmh_server.rate_limit.{verb}"
+DEFAULT_RATE_LIMITS = {
+    "Identify": (60, 60),
+    "ListMetadataFormats": (60, 60),
+    "ListSets": (120, 60),
+    "GetRecord": (120, 60),
+    "ListIdentifiers": (2000, 60),
+    "ListRecords": (400, 60),
+}
+# Limit applied to unknown verbs (pyoai answers them with badVerb), which all
+# share one bucket per client
+DEFAULT_RATE_LIMIT = (60, 60)
+BAD_VERB = "badVerb"
+
+REDIS_KEY_PREFIX = "ckanext.oai_pmh_server.rate_limit"
+
+
+class TokenBucket:
+    """Limit definition: a bucket of ``capacity`` tokens refilled in ``period``
+    seconds."""
+
+    def __init__(self, capacity, period):
+        self.capacity = float(capacity)
+        self.rate = float(capacity) / float(period)
+
+    def refill(self, tokens, last, now):
+        """Return the tokens available at ``now`` given the stored state."""
+        if tokens is None:
+            return self.capacity
+        return min(self.capacity, tokens + (now - last) * self.rate)
+
+    def retry_after(self, tokens):
+        """Seconds until at least one token is available again."""
+        return max(1, int(math.ceil((1 - tokens) / self.rate)))
+
+
+class MemoryBackend:
+    """In-process bucket storage. Each worker process keeps its own buckets.
+
+    Buckets refilled to capacity hold no information and are dropped by a
+    sweep run at most every ``sweep_interval`` seconds.
+    """
+
+    def __init__(self, clock=time.monotonic, sweep_interval=60):
+        self._clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.sweep_interval = sweep_interval
+        self._last_sweep = clock()
+
+    def _sweep(self, now):
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        for key, (tokens, last, bucket) in list(self._buckets.items()):
+            if bucket.refill(tokens, last, now) >= bucket.capacity:
+                del self._buckets[key]
+
+    def _refill(self, key, bucket, now):
+        self._sweep(now)
+        tokens, last, _ = self._buckets.get(key, (None, now, bucket))
+        return bucket.refill(tokens, last, now)
+
+    def acquire(self, key, bucket):
+        """Return 0 if the request is admitted, otherwise the seconds to wait."""
+        with self._lock:
+            now = self._clock()
+            tokens = self._refill(key, bucket, now)
+            if tokens >= bucket.capacity:
+                self._buckets.pop(key, None)
+            else:
+                self._buckets[key] = (tokens, now, bucket)
+            if tokens < 1:
+                return bucket.retry_after(tokens)
+            return 0
+
+    def charge(self, key, bucket, cost):
+        """Remove ``cost`` tokens from the bucket, possibly going negative."""
+        with self._lock:
+            now = self._clock()
+            tokens = self._refill(key, bucket, now)
+            self._buckets[key] = (tokens - cost, now, bucket)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+# KEYS[1]: bucket key
+# ARGV: capacity, rate, now, cost, check (1: admit check, 0: plain charge)
+_REDIS_BUCKET_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(state[1])
+local last = tonumber(state[2])
+if tokens == nil then
+  tokens = capacity
+else
+  tokens = math.min(capacity, tokens + (now - last) * rate)
+end
+if ARGV[5] == '0' then
+  tokens = tokens - tonumber(ARGV[4])
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'last', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+return tostring(tokens)
+"""
+
+
+class RedisBackend:
+    """Bucket storage shared by all workers through CKAN's Redis."""
+
+    def __init__(self, connection=None, clock=time.time):
+        if connection is None:
+            from ckan.lib.redis import connect_to_redis
+
+            connection = connect_to_redis()
+        self._redis = connection
+        self._script = self._redis.register_script(_REDIS_BUCKET_SCRIPT)
+        self._clock = clock
+
+    def _run(self, key, bucket, cost, check):
+        tokens = self._script(
+            keys=["{}:{}".format(REDIS_KEY_PREFIX, key)],
+            args=[bucket.capacity, bucket.rate, self._clock(), cost, check],
+        )
+        return float(tokens)
+
+    def acquire(self, key, bucket):
+        tokens = self._run(key, bucket, 0, 1)
+        if tokens < 1:
+            return bucket.retry_after(tokens)
+        return 0
+
+    def charge(self, key, bucket, cost):
+        self._run(key, bucket, cost, 0)
+
+
+BACKENDS = {
+    "memory": MemoryBackend,
+    "redis": RedisBackend,
+}
+
+
+class RateLimiter:
+    """Per client and per verb token-bucket limiter."""
+
+    def __init__(self, backend, limits=None, default_limit=DEFAULT_RATE_LIMIT):
+        self.backend = backend
+        limits = limits if limits is not None else DEFAULT_RATE_LIMITS
+        self.buckets = {
+            verb: TokenBucket(*limit) for verb, limit in limits.items()
+        }
+        self.default_bucket = TokenBucket(*default_limit)
+
+    def _bucket(self, verb):
+        return self.buckets.get(verb, self.default_bucket)
+
+    def _key(self, client, verb):
+        if verb not in self.buckets:
+            verb = BAD_VERB
+        return "{}:{}".format(verb, client)
+
+    def acquire(self, client, verb):
+        """Check whether ``client`` may issue ``verb`` now.
+
+        :return: 0 if admitted, otherwise the value for Retry-After (seconds)
+        """
+        return self.backend.acquire(self._key(client, verb), self._bucket(verb))
+
+    def charge(self, client, verb, records):
+        """Charge the records served by an admitted request."""
+        self.backend.charge(
+            self._key(client, verb), self._bucket(verb), max(1, records)
+        )
+
+
+def parse_limit(value):
+    """Parse a "<capacity> <period>" limit definition."""
+    capacity, period = str(value).split()
+    capacity, period = int(capacity), int(period)
+    if capacity <= 0 or period <= 0:
+        raise ValueError("Rate limit values must be positive: %r" % value)
+    return capacity, period
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the configured limiter, or None if rate limiting is disabled."""
+    global _limiter
+
+    import ckan.plugins.toolkit as toolkit
+
+    if not toolkit.asbool(
+        toolkit.config.get(
+            RATE_LIMIT_ENABLED_CONFIG_OPTION, DEFAULT_RATE_LIMIT_ENABLED
+        )
+    ):
+        return None
+
+    with _limiter_lock:
+        if _limiter is None:
+            backend_name = toolkit.config.get(
+                RATE_LIMIT_BACKEND_CONFIG_OPTION, DEFAULT_RATE_LIMIT_BACKEND
+            )
+            if backend_name not in BACKENDS:
+                raise ValueError(
+                    "Unknown rate limit backend %r, use one of %s"
+                    % (backend_name, ", ".join(BACKENDS))
+                )
+
+            limits = dict(DEFAULT_RATE_LIMITS)
+            for verb in DEFAULT_RATE_LIMITS:
+                value = toolkit.config.get(
+                    RATE_LIMIT_VERB_CONFIG_OPTION.format(verb=verb.lower()), None
+                )
+                if value:
+                    limits[verb] = parse_limit(value)
+
+            _limiter = RateLimiter(BACKENDS[backend_name](), limits)
+            log.debug(
+                "OAI-PMH rate limiting enabled (%s backend)", backend_name
+            )
+    return _limiter
+
+
+def client_key(request):
+    """Identify the client of ``request`` as configured."""
+    import ckan.plugins.toolkit as toolkit
+
+    key = toolkit.config.get(RATE_LIMIT_KEY_CONFIG_OPTION, DEFAULT_RATE_LIMIT_KEY)
+    if key == "user_agent":
+        return request.headers.get("User-Agent", "") or "unknown"
+    return request.remote_addr or "unknown"
@@ -0,0 +1,456 @@
+"""Background rendering of the RDF records of datasets.
+
+When a dataset is created or updated, its id is added to a pending set and a
+single render job is queued (CKAN's job queue, or an in-process thread). The
+job renders the dataset for every prefix in ``availableMetadataPrefix`` and
+stores the XML, tagged with the dataset metadata_modified, so requests can use
+it instead of serializing the dataset again. Ids scheduled several times
+before the job runs are rendered once, and no more than one job is waiting at
+any time, so bulk imports do not flood the queue.
+
+The hooks run before the dataset change is committed, so each pending id
+carries the metadata_modified the job must find in the database. A job that
+runs before the commit reads an older row and checks again after a growing
+delay, giving up (requests render the record meanwhile) if the change never
+shows up, e.g. because it was rolled back.
+
+Records also depend on data outside the dataset (e.g. the publisher comes from
+its organization), so every group or organization change drops the stored
+records, and records expire after ``ckanext.oai_pmh_server.prerender.ttl``
+seconds in Redis.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import ckan.plugins.toolkit as toolkit
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+PRERENDER_BACKEND_CONFIG_OPTION = "ckanext.oai_pmh_server.prerender.backend"
+# "" (disabled) | ckan (CKAN job queue + Redis) | local (thread + memory)
+DEFAULT_PRERENDER_BACKEND = ""
+
+PRERENDER_DELAY_CONFIG_OPTION = "ckanext.oai_pmh_server.prerender.delay"
+DEFAULT_PRERENDER_DELAY = 2  # seconds, local backend only
+
+PRERENDER_MEMORY_SIZE_CONFIG_OPTION = (
+    "ckanext.oai_pmh_server.prerender.memory_size"
+)
+# Characters of XML kept per worker process, local backend only
+DEFAULT_PRERENDER_MEMORY_SIZE = 64 * 1024 * 1024
+
+PRERENDER_TTL_CONFIG_OPTION = "ckanext.oai_pmh_server.prerender.ttl"
+DEFAULT_PRERENDER_TTL = 24 * 60 * 60  # seconds, ckan backend only
+
+REDIS_KEY_PREFIX = "ckanext.oai_pmh_server.record"
+# Lifetime of the "job queued" flag, so a job lost by the queue does not block
+# rendering forever
+REDIS_SCHEDULED_TTL = 600  # seconds
+
+# Waits for changes not committed yet when the job runs, in seconds
+RENDER_RETRY_DELAYS = (1, 2, 4, 8)
+
+
+class MemoryRecordStore:
+    """Rendered records and pending ids kept in the current process.
+
+    Records are evicted in LRU order once their total size exceeds
+    ``max_size`` characters.
+    """
+
+    def __init__(self, max_size=DEFAULT_PRERENDER_MEMORY_SIZE):
+        self.max_size = max_size
+        self._records = OrderedDict()
+        self._size = 0
+        self._pending = {}
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def get(self, prefix, id, stamp):
+        with self._lock:
+            record = self._records.get((prefix, id))
+            if record is None or record[0] != stamp:
+                return None
+            self._records.move_to_end((prefix, id))
+            return record[1]
+
+    def set(self, prefix, id, stamp, xml):
+        if len(xml) > self.max_size:
+            return
+        with self._lock:
+            if (prefix, id) in self._records:
+                self._remove((prefix, id))
+            self._records[(prefix, id)] = (stamp, xml)
+            self._size += len(xml)
+            while self._size > self.max_size:
+                self._remove(next(iter(self._records)))
+
+    def _remove(self, key):
+        self._size -= len(self._records.pop(key)[1])
+
+    def discard(self, id):
+        with self._lock:
+            for key in [key for key in self._records if key[1] == id]:
+                self._remove(key)
+
+    def invalidate(self):
+        """Forget all the stored records."""
+        with self._lock:
+            self._records.clear()
+            self._size = 0
+
+    def add_pending(self, id, stamp):
+        """Add ``id`` to the pending ids, to be rendered at ``stamp``.
+
+        :return: True if a render job has to be queued
+        """
+        with self._lock:
+            self._pending[id] = stamp
+            if self._scheduled:
+                return False
+            self._scheduled = True
+            return True
+
+    def unschedule(self):
+        """Allow a new job to be queued, the last one could not be."""
+        with self._lock:
+            self._scheduled = False
+
+    def pop_pending(self):
+        """Take all pending ids and stamps, allowing a new job to be queued."""
+        with self._lock:
+            self._scheduled = False
+            pending, self._pending = self._pending, {}
+        return pending
+
+
+class RedisRecordStore:
+    """Rendered records and pending ids shared through CKAN's Redis.
+
+    Records are stored with the current generation, bumped by ``invalidate``,
+    and expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, connection=None, ttl=DEFAULT_PRERENDER_TTL):
+        if connection is None:
+            from ckan.lib.redis import connect_to_redis
+
+            connection = connect_to_redis()
+        self._redis = connection
+        self.ttl = ttl
+        self._pending_key = "{}:pending".format(REDIS_KEY_PREFIX)
+        self._scheduled_key = "{}:scheduled".format(REDIS_KEY_PREFIX)
+        self._generation_key = "{}:generation".format(REDIS_KEY_PREFIX)
+
+    @staticmethod
+    def _key(id):
+        return "{}:{}".format(REDIS_KEY_PREFIX, id)
+
+    @staticmethod
+    def _stamp(generation, stamp):
+        return "{}@{}".format(stamp, int(generation or 0))
+
+    def get(self, prefix, id, stamp):
+        pipe = self._redis.pipeline()
+        pipe.get(self._generation_key)
+        pipe.hmget(self._key(id), "stamp", "xml:" + prefix)
+        generation, (stored_stamp, xml) = pipe.execute()
+        if stored_stamp is None or xml is None:
+            return None
+        if stored_stamp.decode("utf-8") != self._stamp(generation, stamp):
+            return None
+        return xml.decode("utf-8")
+
+    def set(self, prefix, id, stamp, xml):
+        key = self._key(id)
+        stamp = self._stamp(self._redis.get(self._generation_key), stamp)
+        pipe = self._redis.pipeline()
+        # A new stamp invalidates the records of the other prefixes
+        if self._redis.hget(key, "stamp") != stamp.encode("utf-8"):
+            pipe.delete(key)
+        pipe.hset(key, mapping={"stamp": stamp, "xml:" + prefix: xml})
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def invalidate(self):
+        # Records of older generations are ignored until they expire
+        self._redis.incr(self._generation_key)
+
+    def discard(self, id):
+        self._redis.delete(self._key(id))
+
+    def add_pending(self, id, stamp):
+        self._redis.hset(self._pending_key, id, stamp or "")
+        return bool(
+            self._redis.set(
+                self._scheduled_key, 1, nx=True, ex=REDIS_SCHEDULED_TTL
+            )
+        )
+
+    def unschedule(self):
+        self._redis.delete(self._scheduled_key)
+
+    def pop_pending(self):
+        self._redis.delete(self._scheduled_key)
+        pipe = self._redis.pipeline()
+        pipe.hgetall(self._pending_key)
+        pipe.delete(self._pending_key)
+        pending, _ = pipe.execute()
+        return {
+            id.decode("utf-8"): stamp.decode("utf-8") or None
+            for id, stamp in pending.items()
+        }
+
+
+class CKANRenderQueue:
+    """Queue render jobs in CKAN's job queue (run by `ckan jobs worker`)."""
+
+    def enqueue(self):
+        toolkit.enqueue_job(
+            render_pending_records, title="OAI-PMH records rendering"
+        )
+
+
+class LocalRenderQueue:
+    """Run render jobs in a thread of the current process.
+
+    The job waits ``delay`` seconds before taking the pending ids, so bursts of
+    changes are coalesced in a single pass.
+    """
+
+    def __init__(self, delay=DEFAULT_PRERENDER_DELAY):
+        self.delay = delay
+
+    def enqueue(self):
+        # Rendering needs the CKAN application context (config, db session)
+        app = _get_app()
+        thread = threading.Thread(
+            target=self._run, args=(app,), name="oai-pmh-render", daemon=True
+        )
+        thread.start()
+
+    def _run(self, app):
+        from ckan.model import Session
+
+        time.sleep(self.delay)
+        try:
+            if app is None:
+                render_pending_records()
+            else:
+                with app.test_request_context():
+                    render_pending_records()
+        finally:
+            Session.remove()
+
+
+def _get_app():
+    try:
+        from flask import current_app
+
+        return current_app._get_current_object()
+    except RuntimeError:
+        return None
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Return the configured (store, queue) pair or None if disabled."""
+    global _backend
+
+    name = toolkit.config.get(
+        PRERENDER_BACKEND_CONFIG_OPTION, DEFAULT_PRERENDER_BACKEND
+    )
+    if not name:
+        return None
+
+    with _backend_lock:
+        if _backend is None:
+            if name == "ckan":
+                ttl = toolkit.asint(
+                    toolkit.config.get(
+                        PRERENDER_TTL_CONFIG_OPTION, DEFAULT_PRERENDER_TTL
+                    )
+                )
+                _backend = (RedisRecordStore(ttl=ttl), CKANRenderQueue())
+            elif name == "local":
+                delay = toolkit.asint(
+                    toolkit.config.get(
+                        PRERENDER_DELAY_CONFIG_OPTION, DEFAULT_PRERENDER_DELAY
+                    )
+                )
+                size = toolkit.asint(
+                    toolkit.config.get(
+                        PRERENDER_MEMORY_SIZE_CONFIG_OPTION,
+                        DEFAULT_PRERENDER_MEMORY_SIZE,
+                    )
+                )
+                _backend = (MemoryRecordStore(size), LocalRenderQueue(delay))
+            else:
+                raise ValueError(
+                    "Unknown prerender backend %r, use ckan or local" % name
+                )
+    return _backend
+
+
+def get_stamp(modified):
+    """Version of a stored record: the dataset metadata_modified."""
+    return modified.isoformat()
+
+
+def schedule_render(id, modified=None):
+    """Render the records of dataset ``id`` in the background.
+
+    :param modified: metadata_modified of the change being saved, the job waits
+        until the database row is at least as recent
+    """
+    backend = get_backend()
+    if backend is None:
+        return
+    store, queue = backend
+    if store.add_pending(id, get_stamp(modified) if modified else None):
+        try:
+            queue.enqueue()
+        except Exception:
+            # Records are rendered on request meanwhile, do not fail the
+            # dataset change
+            store.unschedule()
+            log.exception("Could not queue the OAI-PMH records rendering")
+
+
+def discard(id):
+    """Forget the rendered records of dataset ``id``."""
+    backend = get_backend()
+    if backend is not None:
+        backend[0].discard(id)
+
+
+def invalidate():
+    """Forget the rendered records of all datasets."""
+    backend = get_backend()
+    if backend is not None:
+        backend[0].invalidate()
+
+
+def _format_key(prefix):
+    """Storage key of a prefix, which changes with the prefix profiles."""
+    from .metadata_registry import availableMetadataPrefix
+
+    return "{}:{}".format(
+        prefix, ",".join(availableMetadataPrefix[prefix]["profiles"])
+    )
+
+
+def get_record(prefix, id, modified):
+    """Return the stored XML of a dataset if it is up to date, else None."""
+    backend = get_backend()
+    if backend is None:
+        return None
+    return backend[0].get(_format_key(prefix), id, get_stamp(modified))
+
+
+def store_record(prefix, id, modified, xml):
+    backend = get_backend()
+    if backend is not None:
+        backend[0].set(_format_key(prefix), id, get_stamp(modified), xml)
+
+
+def render_xml(package_dict, prefix, compatibility_mode=False):
+    """Serialize a package dict with the profiles of ``prefix``."""
+    from .metadata_registry import get_rdf_serializer
+
+    # We need to create a new RDF serializer every time, in order to
+    # reset the internal graph. Otherwise, using always the same instance,
+    # objects will be appended
+    rdfserializer = get_rdf_serializer(prefix)(
+        compatibility_mode=compatibility_mode
+    )
+    return rdfserializer.serialize_dataset(package_dict, _format="xml")
+
+
+def _is_committed(package, stamp):
+    """Whether the change scheduled at ``stamp`` is visible in ``package``."""
+    if stamp is None or package is None:
+        return True
+    return package.metadata_modified >= datetime.fromisoformat(stamp)
+
+
+def render_dataset(id, stamp=None):
+    """Render and store the records of a dataset for every RDF prefix.
+
+    :param stamp: metadata_modified the dataset was scheduled at
+    :return: False if the change is not committed yet, nothing was rendered
+    """
+    from ckan.model import Package
+
+    from .metadata_registry import availableMetadataPrefix
+
+    package = Package.get(id)
+    if not _is_committed(package, stamp):
+        return False
+    if (
+        package is None
+        or package.state != "active"
+        or package.private
+        or package.type != "dataset"
+    ):
+        discard(id)
+        return True
+
+    package_dict = toolkit.get_action("package_show")(
+        {"ignore_auth": True}, {"id": package.id}
+    )
+    for prefix in availableMetadataPrefix:
+        store_record(
+            prefix,
+            package.id,
+            package.metadata_modified,
+            render_xml(package_dict, prefix),
+        )
+    return True
+
+
+def _render_datasets(pending):
+    """Render the pending datasets, return the ones not committed yet."""
+    waiting = {}
+    for id, stamp in pending.items():
+        try:
+            if not render_dataset(id, stamp):
+                waiting[id] = stamp
+        except Exception:
+            log.exception("Could not render OAI-PMH records of %s", id)
+    return waiting
+
+
+def render_pending_records():
+    """Job: render every dataset scheduled since the previous job."""
+    from ckan.model import Session
+
+    backend = get_backend()
+    if backend is None:
+        return
+    pending = backend[0].pop_pending()
+    log.debug("Rendering OAI-PMH records of %d datasets", len(pending))
+    pending = _render_datasets(pending)
+    for delay in RENDER_RETRY_DELAYS:
+        if not pending:
+            return
+        time.sleep(delay)
+        # Read the rows again, committed by other transactions meanwhile
+        Session.rollback()
+        Session.expire_all()
+        pending = _render_datasets(pending)
+    if pending:
+        log.warning(
+            "Changes of %d datasets were not committed, their OAI-PMH records "
+            "are rendered on request",
+            len(pending),
+        )
@@ -0,0 +1,168 @@
+"""Whole-page cache of ListRecords and ListIdentifiers responses.
+
+Responses are keyed by the normalized request arguments plus a catalog version
+stamp (latest metadata_modified and number of public datasets, overall and in
+the requested set). Identical requests against an unchanged catalog are served
+from memory, the version check being their only database access. Entries are
+stored gzip compressed and evicted in LRU order once the configured size is
+reached. The cache is disabled unless a size is configured.
+"""
+
+import gzip
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from urllib.parse import parse_qs
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+RESPONSE_CACHE_SIZE_CONFIG_OPTION = "ckanext.oai_pmh_server.response_cache.size"
+# Compressed bytes per worker process, 0 disables the cache
+DEFAULT_RESPONSE_CACHE_SIZE = 0
+
+RESPONSE_CACHE_TTL_CONFIG_OPTION = "ckanext.oai_pmh_server.response_cache.ttl"
+DEFAULT_RESPONSE_CACHE_TTL = 600  # seconds
+
+CACHED_VERBS = ("ListRecords", "ListIdentifiers")
+
+CacheEntry = namedtuple("CacheEntry", ["data", "records", "expires"])
+
+
+class ResponseCache:
+    """Size-bounded LRU of compressed responses."""
+
+    def __init__(self, max_size, clock=time.monotonic):
+        self.max_size = max_size
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the CacheEntry of ``key`` or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= self._clock():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, response, records, ttl):
+        """Store the response bytes of ``key`` for ``ttl`` seconds."""
+        if ttl <= 0:
+            return
+        if isinstance(response, str):
+            response = response.encode("utf-8")
+        # Fastest level: XML compresses well anyway, and this runs on the
+        # request path
+        data = gzip.compress(response, compresslevel=1)
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = CacheEntry(data, records, self._clock() + ttl)
+            self._size += len(data)
+            while self._size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        self._size -= len(self._entries.pop(key).data)
+
+
+def catalog_version(spec=None):
+    """Cheap stamp that changes whenever the listed datasets may change."""
+    from sqlalchemy import func
+
+    from ckan.model import Member, Package, Session
+
+    from .set_catalog import set_catalog
+
+    query = (
+        Session.query(
+            func.max(Package.metadata_modified), func.count(Package.id)
+        )
+        .filter(Package.type == "dataset")
+        .filter(Package.state == "active")
+        .filter(Package.private == False)
+    )
+    version = tuple(query.one())
+    group = set_catalog.get(spec) if spec else None
+    if group is not None:
+        group_query = (
+            query.join(Member, Member.table_id == Package.id)
+            .filter(Member.group_id == group.id)
+            .filter(Member.table_name == "package")
+            .filter(Member.state == "active")
+        )
+        version += (group.id,) + tuple(group_query.one())
+    return version
+
+
+def request_key(params):
+    """Cache key for the cleaned request arguments, None if not cacheable."""
+    if params.get("verb") not in CACHED_VERBS:
+        return None
+    spec = params.get("set")
+    if params.get("resumptionToken"):
+        spec = parse_qs(params["resumptionToken"]).get("set", [None])[0]
+    return (tuple(sorted(params.items())), catalog_version(spec))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Return the process response cache, or None if it is disabled."""
+    global _cache
+
+    import ckan.plugins.toolkit as toolkit
+
+    size = toolkit.asint(
+        toolkit.config.get(
+            RESPONSE_CACHE_SIZE_CONFIG_OPTION, DEFAULT_RESPONSE_CACHE_SIZE
+        )
+    )
+    if size <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(size)
+    return _cache
+
+
+def get_ttl(resumption_validity):
+    """Lifetime of an entry.
+
+    Cached pages embed the expirationDate of their resumptionToken, so they are
+    not served for more than half of the token validity.
+    """
+    import ckan.plugins.toolkit as toolkit
+
+    ttl = toolkit.asint(
+        toolkit.config.get(
+            RESPONSE_CACHE_TTL_CONFIG_OPTION, DEFAULT_RESPONSE_CACHE_TTL
+        )
+    )
+    if resumption_validity > 0:
+        ttl = min(ttl, resumption_validity // 2)
+    return ttl
+
+
+def make_response(entry, accept_gzip):
+    """Build the HTTP response of a cached entry."""
+    from flask import Response
+
+    if accept_gzip:
+        return Response(
+            entry.data,
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+        )
+    return gzip.decompress(entry.data)
@@ -0,0 +1,106 @@
+"""In-memory catalog of the OAI-PMH sets (CKAN organizations and groups).
+
+The catalog maps each setSpec (group name) to the group id and type. It is
+built on first use, dropped by the group/organization hooks of the plugin and
+rebuilt after a configurable time, since other worker processes keep their own
+copy. Sets missing from the catalog are looked up in the database, so a set
+created in another worker is found before the catalog is rebuilt.
+"""
+
+import threading
+import time
+from collections import namedtuple
+
+import ckan.plugins.toolkit as toolkit
+from ckan.model import Group, Session
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+SET_CATALOG_TTL_CONFIG_OPTION = "ckanext.oai_pmh_server.set_catalog_ttl"
+DEFAULT_SET_CATALOG_TTL = 300  # seconds, 0 to only refresh on group changes
+
+SetEntry = namedtuple("SetEntry", ["id", "name", "title", "description", "type"])
+
+
+class SetCatalog:
+    def __init__(self):
+        self._sets = None
+        self._specs = []
+        self._built_at = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Drop the catalog, it will be rebuilt on next use."""
+        with self._lock:
+            self._sets = None
+            self._specs = []
+            self._generation += 1
+
+    @staticmethod
+    def _load():
+        groups = (
+            Session.query(
+                Group.id, Group.name, Group.title, Group.description, Group.type
+            )
+            .filter(Group.state == "active")
+            .order_by(Group.name)
+        )
+        return {
+            name: SetEntry(id, name, title, description, type)
+            for id, name, title, description, type in groups
+        }
+
+    def _get_sets(self):
+        ttl = toolkit.asint(
+            toolkit.config.get(
+                SET_CATALOG_TTL_CONFIG_OPTION, DEFAULT_SET_CATALOG_TTL
+            )
+        )
+        with self._lock:
+            if self._sets is not None and (
+                ttl <= 0 or time.monotonic() - self._built_at < ttl
+            ):
+                return self._sets, self._specs
+            generation = self._generation
+
+        sets = self._load()
+        specs = list(sets)
+        log.debug("OAI-PMH set catalog built with %d sets", len(sets))
+
+        with self._lock:
+            # Do not keep a catalog invalidated while it was being built
+            if generation == self._generation:
+                self._sets = sets
+                self._specs = specs
+                self._built_at = time.monotonic()
+        return sets, specs
+
+    def get(self, spec):
+        """Return the SetEntry of ``spec`` or None if it does not exist."""
+        sets, _ = self._get_sets()
+        entry = sets.get(spec)
+        if entry is not None:
+            return entry
+
+        # Created after the catalog was built (possibly in another worker)
+        group = Group.get(spec)
+        if group is None or group.state != "active":
+            return None
+        self.invalidate()
+        return SetEntry(
+            group.id, group.name, group.title, group.description, group.type
+        )
+
+    def page(self, cursor=None, batch_size=None):
+        """Return a page of SetEntry ordered by setSpec and the total count."""
+        sets, specs = self._get_sets()
+        if cursor is not None:
+            specs = specs[cursor:cursor + batch_size]
+        return [sets[spec] for spec in specs], len(sets)
+
+
+set_catalog = SetCatalog()
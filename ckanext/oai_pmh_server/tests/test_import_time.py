@@ -0,0 +1,64 @@
+"""Startup cost regression tests for plugin.py.
+
+Loading the plugin must not import the OAI-PMH/RDF stack, which is only
+needed by workers serving /oai.
+"""
+import subprocess
+import sys
+
+# Modules that must only be imported on the first /oai request
+LAZY_MODULES = (
+    "ckanext.oai_pmh_server.ckan_oai_pmh_server_wrapper",
+    "ckanext.oai_pmh_server.oaipmh_server",
+    "ckanext.oai_pmh_server.metadata_registry",
+    "ckanext.dcat",
+    "rdflib",
+    "oaipmh",
+)
+
+# Extra memory allowed for importing the plugin, in KiB
+PLUGIN_RSS_BUDGET_KB = 5 * 1024
+
+_MEASURE_RSS = """
+import resource
+import ckan.model, ckan.plugins, ckan.plugins.toolkit, ckan.lib.base, flask
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+import ckanext.oai_pmh_server.plugin
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(after - before)
+"""
+
+
+def test_plugin_import_does_not_load_rdf_stack():
+    proc = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "import ckanext.oai_pmh_server.plugin",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # import time: self [us] | cumulative | imported package
+    imported = {
+        line.split("|")[-1].strip()
+        for line in proc.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+
+    assert "ckanext.oai_pmh_server.plugin" in imported
+    for module in imported:
+        assert not module.startswith(LAZY_MODULES), module
+
+
+def test_plugin_import_memory():
+    proc = subprocess.run(
+        [sys.executable, "-c", _MEASURE_RSS],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert int(proc.stdout.strip()) < PLUGIN_RSS_BUDGET_KB
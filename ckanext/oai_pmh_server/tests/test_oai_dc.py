@@ -0,0 +1,82 @@
+"""Tests for oai_dc.py."""
+import json
+
+import pytest
+
+from ckanext.oai_pmh_server.oai_dc import dublin_core, get_json_content
+
+
+def test_get_json_content():
+    assert get_json_content(json.dumps({"en": "Title", "es": "Titulo"})) == [
+        "Title",
+        "Titulo",
+    ]
+    assert get_json_content("Plain title") == ["Plain title"]
+    assert get_json_content("{not json") == ["{not json"]
+
+
+@pytest.mark.usefixtures("with_request_context")
+def test_dublin_core():
+    package = {
+        "id": "abc",
+        "name": "my-dataset",
+        "type": "dataset",
+        "title": "My dataset",
+        "notes": "Some notes",
+        "language": "en, es",
+        "metadata_created": "2023-05-04T10:11:12.123456",
+        "tags": [{"display_name": "air"}],
+        "agent": [
+            {"role": "author", "name": "Ann"},
+            {"role": "distributor", "name": "Dist"},
+            {"role": "contributor", "name": "Con"},
+            {"role": "author"},
+        ],
+        "contact": [{"name": "Contact"}],
+        "extras": [{"key": "custom", "value": "value"}],
+    }
+
+    metadata = dublin_core(package)
+
+    assert metadata["title"] == ["My dataset"]
+    assert metadata["creator"] == ["Ann"]
+    assert metadata["publisher"] == ["Dist", "Contact"]
+    assert metadata["contributor"] == ["Con"]
+    assert metadata["language"] == ["en", "es"]
+    assert metadata["subject"] == ["air"]
+    assert metadata["date"] == ["2023-05-04"]
+    assert "rights" not in metadata
+    assert metadata["custom"] == ["value"]
+    assert metadata["identifier"][:1] == ["abc"]
+    assert metadata["identifier"][-1].endswith("/dataset/my-dataset")
+
+
+def test_package_dicts_skip_stale_search_results(monkeypatch):
+    from datetime import datetime
+    from types import SimpleNamespace
+
+    from ckanext.oai_pmh_server import oai_dc
+
+    fresh = SimpleNamespace(id="a", metadata_modified=datetime(2023, 1, 2))
+    stale = SimpleNamespace(id="b", metadata_modified=datetime(2023, 1, 2))
+    shown = []
+
+    def package_search(context, data_dict):
+        return {
+            "results": [
+                {"id": "a", "metadata_modified": "2023-01-02T00:00:00"},
+                {"id": "b", "metadata_modified": "2023-01-01T00:00:00"},
+            ]
+        }
+
+    def package_show(context, data_dict):
+        shown.append(data_dict["id"])
+        return {"id": data_dict["id"], "metadata_modified": "2023-01-02T00:00:00"}
+
+    actions = {"package_search": package_search, "package_show": package_show}
+    monkeypatch.setattr(oai_dc, "get_action", actions.get)
+
+    packages = oai_dc.package_dicts([fresh, stale])
+
+    assert shown == ["b"]
+    assert packages["b"]["metadata_modified"] == "2023-01-02T00:00:00"
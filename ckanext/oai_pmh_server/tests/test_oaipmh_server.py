@@ -0,0 +1,216 @@
+"""Tests for oaipmh_server.py."""
+from datetime import datetime
+
+import pytest
+from lxml import etree
+
+from oaipmh.error import BadResumptionTokenError
+
+from ckan import model
+from ckan.plugins.toolkit import url_for
+from ckan.tests import factories
+
+from ckanext.oai_pmh_server.oaipmh_server import (
+    CKANServer,
+    _decode_after,
+    _encode_after,
+)
+
+NS = {"oai": "http://www.openarchives.org/OAI/2.0/"}
+
+
+def _set_modified(id, modified):
+    model.Session.query(model.Package).filter_by(id=id).update(
+        {"metadata_modified": modified}
+    )
+    model.Session.commit()
+
+
+def _header_ids(set=None, from_=None, until=None):
+    headers, _, _ = CKANServer._filter_headers(set, None, from_, until, None)
+    return [header.identifier() for header in headers]
+
+
+def _harvest(app, verb, **params):
+    """Follow the resumptionTokens of a list request.
+
+    :return: list of pages, each a dict with the headers (identifier,
+        datestamp, setSpec) and the resumptionToken attributes
+    """
+
+    pages = []
+    query = dict(params, verb=verb)
+    while True:
+        response = app.get(
+            url_for("oai_pmh_server.oai_action"), query_string=query
+        )
+        assert response.status_code == 200
+        e_verb = etree.fromstring(response.data).find("oai:" + verb, NS)
+        assert e_verb is not None, response.data
+        page = {
+            "headers": [
+                (
+                    e_header.findtext("oai:identifier", namespaces=NS),
+                    e_header.findtext("oai:datestamp", namespaces=NS),
+                    e_header.findtext("oai:setSpec", namespaces=NS),
+                )
+                for e_header in e_verb.iter("{%s}header" % NS["oai"])
+            ],
+            "token": None,
+        }
+        pages.append(page)
+        e_token = e_verb.find("oai:resumptionToken", NS)
+        if e_token is None:
+            return pages
+        page["token"] = e_token.text
+        page["cursor"] = int(e_token.get("cursor"))
+        page["completeListSize"] = int(e_token.get("completeListSize"))
+        if not e_token.text:
+            return pages
+        query = {"verb": verb, "resumptionToken": e_token.text}
+
+
+def test_resumption_position_round_trip():
+    modified = datetime(2023, 5, 4, 10, 11, 12, 123456)
+
+    after = _encode_after(modified, "abc-123")
+
+    assert _decode_after(after) == (modified, "abc-123")
+
+
+def test_invalid_resumption_position():
+    with pytest.raises(BadResumptionTokenError):
+        _decode_after("not-a-position")
+
+
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+@pytest.mark.ckan_config(
+    "ckanext.oai_pmh_server.resumption_token_batch_size", "4"
+)
+@pytest.mark.parametrize(
+    "count, page_sizes", [(10, [4, 4, 2]), (8, [4, 4]), (3, [3])]
+)
+@pytest.mark.parametrize("verb", ["ListIdentifiers", "ListRecords"])
+def test_pages_hold_the_configured_number_of_records(
+    app, verb, count, page_sizes
+):
+    datasets = [factories.Dataset() for _ in range(count)]
+
+    pages = _harvest(app, verb, metadataPrefix="oai_dc")
+
+    assert [len(page["headers"]) for page in pages] == page_sizes
+    served = 0
+    for page in pages:
+        served += len(page["headers"])
+        if page["token"] is None:
+            continue
+        assert page["cursor"] == served
+        assert page["cursor"] <= page["completeListSize"] == count
+    # The page that completes a full list has an empty resumptionToken
+    assert not pages[-1]["token"]
+    ids = [id for page in pages for id, _, _ in page["headers"]]
+    assert sorted(ids) == sorted(dataset["id"] for dataset in datasets)
+
+
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+def test_dates_are_inclusive_at_second_granularity():
+    stamps = {
+        "early": datetime(2023, 1, 1, 9, 59, 59, 999999),
+        "first": datetime(2023, 1, 1, 10, 0, 0, 500000),
+        "second": datetime(2023, 1, 1, 10, 0, 1),
+        "last": datetime(2023, 1, 1, 10, 0, 2, 999999),
+        "late": datetime(2023, 1, 1, 10, 0, 3),
+    }
+    ids = {}
+    for name, modified in stamps.items():
+        ids[name] = factories.Dataset()["id"]
+        _set_modified(ids[name], modified)
+
+    listed = _header_ids(
+        from_=datetime(2023, 1, 1, 10, 0, 0),
+        # A datestamp covers its whole second, whatever the microseconds
+        until=datetime(2023, 1, 1, 10, 0, 2, 100),
+    )
+    assert listed == [ids["first"], ids["second"], ids["last"]]
+
+    assert _header_ids(
+        from_=datetime(2023, 1, 1, 10, 0, 1),
+        until=datetime(2023, 1, 1, 10, 0, 1),
+    ) == [ids["second"]]
+
+
+@pytest.mark.usefixtures("clean_db", "with_plugins", "with_request_context")
+def test_header_datestamp_is_metadata_modified():
+    dataset = factories.Dataset()
+    modified = datetime(2023, 5, 4, 10, 11, 12, 123456)
+    _set_modified(dataset["id"], modified)
+
+    (header,), _, _ = CKANServer._filter_headers(None, None, None, None, None)
+    records = CKANServer().listRecords(metadataPrefix="oai_dc")
+
+    assert header.datestamp() == modified.replace(microsecond=0)
+    # The first record is the internal header
+    assert records[1][0].datestamp() == header.datestamp()
+
+
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+def test_paging_survives_datasets_edited_during_the_harvest():
+    ids = [factories.Dataset()["id"] for _ in range(6)]
+    for minute, id in enumerate(ids):
+        _set_modified(id, datetime(2023, 1, 1, 10, minute))
+
+    listed = []
+    # 3 = page size 2 + internal header
+    headers, _, after = CKANServer._filter_headers(None, 0, None, None, 3)
+    listed += [header.identifier() for header in headers]
+
+    # Edit a listed dataset and one not listed yet: with an offset, both
+    # would shift the remaining datasets and skip one of them
+    _set_modified(ids[0], datetime(2023, 1, 1, 11))
+    _set_modified(ids[3], datetime(2023, 1, 1, 11, 1))
+
+    while after is not None:
+        headers, _, after = CKANServer._filter_headers(
+            None, 0, None, None, 3, after
+        )
+        listed += [header.identifier() for header in headers]
+
+    # The edited listed dataset is listed again with its new datestamp, the
+    # other datasets exactly once
+    assert listed == ids[:2] + [ids[2], ids[4], ids[5], ids[0], ids[3]]
+
+
+@pytest.mark.usefixtures("clean_db", "with_plugins", "with_request_context")
+def test_set_spec_is_resolved_per_dataset():
+    org = factories.Organization(name="org-a")
+    with_org = factories.Dataset(owner_org=org["id"])
+    without_org = factories.Dataset(name="no-org-dataset")
+    _set_modified(with_org["id"], datetime(2023, 1, 1, 10))
+    _set_modified(without_org["id"], datetime(2023, 1, 1, 11))
+
+    headers, _, _ = CKANServer._filter_headers(None, None, None, None, None)
+    records = CKANServer().listRecords(metadataPrefix="oai_dc")[1:]
+    in_set = CKANServer().listRecords(metadataPrefix="oai_dc", set="org-a")[1:]
+
+    expected = [["org-a"], ["no-org-dataset"]]
+    assert [header.setSpec() for header in headers] == expected
+    assert [header.setSpec() for header, _, _ in records] == expected
+    assert [header.setSpec() for header, _, _ in in_set] == [["org-a"]]
+
+
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+@pytest.mark.ckan_config(
+    "ckanext.oai_pmh_server.resumption_token_batch_size", "2"
+)
+def test_list_identifiers_matches_list_records(app):
+    org = factories.Organization()
+    for _ in range(3):
+        factories.Dataset(owner_org=org["id"])
+        factories.Dataset()
+
+    identifiers = _harvest(app, "ListIdentifiers", metadataPrefix="oai_dc")
+    records = _harvest(app, "ListRecords", metadataPrefix="oai_dc")
+
+    assert [page["headers"] for page in identifiers] == [
+        page["headers"] for page in records
+    ]
@@ -47,7 +47,212 @@ To temporary patch the CKAN configuration for the duration of a test you can use
     def test_some_action():
         pass
 """
+import gzip
+
+import pytest
+from lxml import etree
+
+from ckan.plugins.toolkit import url_for
+from ckan.tests import factories, helpers
+
 import ckanext.oai_pmh_server.plugin as plugin
+from ckanext.oai_pmh_server import response_cache
 
 def test_plugin():
     pass
+
+
+@pytest.mark.ckan_config("ckanext.oai_pmh_server.prerender.backend", "")
+def test_dataset_changes_skip_rendering_when_disabled(monkeypatch):
+    from ckan.model import Package
+
+    def get(id):
+        raise AssertionError("Package looked up with prerendering disabled")
+
+    monkeypatch.setattr(Package, "get", get)
+
+    plugin._schedule_render("any-id")
+
+
+@pytest.fixture
+def handled(monkeypatch):
+    """Verbs of the requests not served from the cache."""
+    from ckanext.oai_pmh_server.ckan_oai_pmh_server_wrapper import (
+        CKANOAIPMHServerWrapper,
+    )
+
+    calls = []
+    handle_request = CKANOAIPMHServerWrapper.handleRequest
+
+    def spy(self, params):
+        calls.append(params.get("verb"))
+        return handle_request(self, params)
+
+    monkeypatch.setattr(CKANOAIPMHServerWrapper, "handleRequest", spy)
+    # Start from an empty cache
+    monkeypatch.setattr(response_cache, "_cache", None)
+    return calls
+
+
+def _get(app, headers=None, **params):
+    response = app.get(
+        url_for("oai_pmh_server.oai_action"),
+        query_string=params,
+        headers=headers or {},
+    )
+    assert response.status_code == 200
+    return response
+
+
+CACHE_CONFIG = pytest.mark.ckan_config(
+    "ckanext.oai_pmh_server.response_cache.size", "1048576"
+)
+
+
+@CACHE_CONFIG
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+def test_identical_requests_are_served_from_the_cache(app, handled):
+    factories.Dataset()
+
+    first = _get(app, verb="ListRecords", metadataPrefix="oai_dc")
+    second = _get(app, verb="ListRecords", metadataPrefix="oai_dc")
+
+    assert handled == ["ListRecords"]
+    assert second.data == first.data
+
+
+def _edit(dataset, group):
+    helpers.call_action("package_patch", id=dataset["id"], notes="Edited")
+
+
+def _add_to_group(dataset, group):
+    helpers.call_action(
+        "member_create",
+        id=group["id"],
+        object=dataset["id"],
+        object_type="package",
+        capacity="public",
+    )
+
+
+def _make_private(dataset, group):
+    helpers.call_action("package_patch", id=dataset["id"], private=True)
+
+
+@CACHE_CONFIG
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+@pytest.mark.parametrize(
+    "change, in_set",
+    [(_edit, False), (_add_to_group, True), (_make_private, False)],
+)
+def test_catalog_changes_are_cache_misses(app, handled, change, in_set):
+    org = factories.Organization()
+    group = factories.Group()
+    listed = factories.Dataset(owner_org=org["id"])
+    changed = factories.Dataset(owner_org=org["id"])
+    _add_to_group(listed, group)
+    params = {"verb": "ListIdentifiers", "metadataPrefix": "oai_dc"}
+    if in_set:
+        params["set"] = group["name"]
+
+    _get(app, **params)
+    _get(app, **params)
+    assert len(handled) == 1
+
+    change(changed, group)
+    _get(app, **params)
+
+    assert len(handled) == 2
+
+
+@CACHE_CONFIG
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+@pytest.mark.ckan_config(
+    "ckanext.oai_pmh_server.resumption_token_batch_size", "2"
+)
+def test_resumption_requests_are_keyed_by_their_set(app, handled):
+    group = factories.Group()
+    datasets = [factories.Dataset() for _ in range(4)]
+    for dataset in datasets[:3]:
+        _add_to_group(dataset, group)
+    first_page = _get(
+        app, verb="ListIdentifiers", metadataPrefix="oai_dc", set=group["name"]
+    )
+    token = etree.fromstring(first_page.data).findtext(
+        ".//{http://www.openarchives.org/OAI/2.0/}resumptionToken"
+    )
+
+    _get(app, verb="ListIdentifiers", resumptionToken=token)
+    _get(app, verb="ListIdentifiers", resumptionToken=token)
+    assert len(handled) == 2
+
+    # The token does not carry the set as an argument of the request: the
+    # request is still invalidated by changes to the set
+    _add_to_group(datasets[3], group)
+    _get(app, verb="ListIdentifiers", resumptionToken=token)
+
+    assert len(handled) == 3
+
+
+@CACHE_CONFIG
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+def test_compressed_and_identity_hits_have_the_same_body(app, handled):
+    factories.Dataset()
+    params = {"verb": "ListRecords", "metadataPrefix": "oai_dc"}
+
+    _get(app, **params)
+    compressed = _get(app, headers={"Accept-Encoding": "gzip"}, **params)
+    identity = _get(app, **params)
+
+    assert handled == ["ListRecords"]
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert "Content-Encoding" not in identity.headers
+    assert gzip.decompress(compressed.data) == identity.data
+
+
+@pytest.fixture
+def rate_limiter(monkeypatch):
+    from ckanext.oai_pmh_server import rate_limit
+
+    # Built again from the configuration of the test
+    monkeypatch.setattr(rate_limit, "_limiter", None)
+
+
+RATE_LIMIT_CONFIG = pytest.mark.ckan_config(
+    "ckanext.oai_pmh_server.rate_limit.enabled", "true"
+)
+
+
+@RATE_LIMIT_CONFIG
+@pytest.mark.ckan_config("ckanext.oai_pmh_server.rate_limit.identify", "1 600")
+@pytest.mark.usefixtures("with_plugins", "rate_limiter")
+def test_requests_over_budget_get_503_and_retry_after(app):
+    url = url_for("oai_pmh_server.oai_action")
+
+    assert app.get(url, query_string={"verb": "Identify"}).status_code == 200
+    response = app.get(url, query_string={"verb": "Identify"})
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "600"
+
+
+@RATE_LIMIT_CONFIG
+@pytest.mark.ckan_config(
+    "ckanext.oai_pmh_server.rate_limit.listrecords", "3 600"
+)
+@pytest.mark.ckan_config(
+    "ckanext.oai_pmh_server.resumption_token_batch_size", "4"
+)
+@pytest.mark.usefixtures("clean_db", "with_plugins", "rate_limiter")
+def test_list_requests_are_charged_by_records_served(app):
+    for _ in range(5):
+        factories.Dataset()
+    url = url_for("oai_pmh_server.oai_action")
+    params = {"verb": "ListRecords", "metadataPrefix": "oai_dc"}
+
+    assert app.get(url, query_string=params).status_code == 200
+    # 4 records served for 3 tokens: charging 1 would leave 2 tokens
+    response = app.get(url, query_string=params)
+
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) > 0
@@ -0,0 +1,79 @@
+"""Tests for rate_limit.py."""
+import pytest
+
+from ckanext.oai_pmh_server.rate_limit import (
+    MemoryBackend,
+    RateLimiter,
+    parse_limit,
+)
+
+
+@pytest.fixture
+def make_limiter(clock):
+    def make(limits):
+        return RateLimiter(MemoryBackend(clock=clock), limits)
+
+    return make
+
+
+def test_requests_over_budget_get_retry_after(make_limiter, clock):
+    limiter = make_limiter({"Identify": (2, 10)})
+
+    for _ in range(2):
+        assert limiter.acquire("1.2.3.4", "Identify") == 0
+        limiter.charge("1.2.3.4", "Identify", 1)
+
+    assert limiter.acquire("1.2.3.4", "Identify") == 5
+
+    clock.now = 5
+    assert limiter.acquire("1.2.3.4", "Identify") == 0
+
+
+def test_charge_is_weighted_by_records_served(make_limiter, clock):
+    limiter = make_limiter({"ListRecords": (100, 100)})
+
+    assert limiter.acquire("harvester", "ListRecords") == 0
+    limiter.charge("harvester", "ListRecords", 150)
+
+    # 50 tokens in debt: 51 seconds until one token is available again
+    assert limiter.acquire("harvester", "ListRecords") == 51
+    clock.now = 51
+    assert limiter.acquire("harvester", "ListRecords") == 0
+
+
+def test_buckets_are_per_client_and_verb(make_limiter):
+    limiter = make_limiter({"ListRecords": (1, 60), "Identify": (1, 60)})
+
+    limiter.charge("a", "ListRecords", 1)
+
+    assert limiter.acquire("a", "ListRecords") > 0
+    assert limiter.acquire("a", "Identify") == 0
+    assert limiter.acquire("b", "ListRecords") == 0
+
+
+def test_parse_limit():
+    assert parse_limit("200 60") == (200, 60)
+    with pytest.raises(ValueError):
+        parse_limit("0 60")
+
+
+def test_unknown_verbs_share_one_bucket(make_limiter):
+    limiter = make_limiter({"Identify": (1, 60)})
+
+    limiter.charge("a", "Whatever", 60)
+
+    assert limiter.acquire("a", "SomethingElse") > 0
+    assert len(limiter.backend) == 1
+
+
+def test_refilled_buckets_are_dropped(make_limiter, clock):
+    limiter = make_limiter({"Identify": (10, 10)})
+
+    for client in ("a", "b", "c"):
+        limiter.charge(client, "Identify", 5)
+    assert len(limiter.backend) == 3
+
+    clock.now = 60
+    assert limiter.acquire("d", "Identify") == 0
+
+    assert len(limiter.backend) == 0
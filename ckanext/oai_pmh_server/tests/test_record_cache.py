@@ -0,0 +1,168 @@
+"""Tests for record_cache.py."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from ckanext.oai_pmh_server import record_cache
+
+
+class FakeQueue:
+    def __init__(self):
+        self.jobs = 0
+        self.fail = False
+
+    def enqueue(self):
+        if self.fail:
+            raise ConnectionError("queue down")
+        self.jobs += 1
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    store, queue = record_cache.MemoryRecordStore(), FakeQueue()
+    monkeypatch.setattr(record_cache, "get_backend", lambda: (store, queue))
+    return store, queue
+
+
+def test_changes_are_coalesced_in_one_job(backend, monkeypatch):
+    store, queue = backend
+    rendered = []
+    monkeypatch.setattr(
+        record_cache,
+        "render_dataset",
+        lambda id, stamp: rendered.append(id) or True,
+    )
+
+    for _ in range(3):
+        for id in ("a", "b", "c"):
+            record_cache.schedule_render(id)
+
+    assert queue.jobs == 1
+
+    record_cache.render_pending_records()
+
+    assert sorted(rendered) == ["a", "b", "c"]
+
+    # A new change after the job took the pending ids queues a new job
+    record_cache.schedule_render("a")
+    assert queue.jobs == 2
+
+
+def test_stored_records_follow_metadata_modified(backend):
+    modified = datetime(2023, 1, 1, 10, 0, 0, 123)
+
+    record_cache.store_record("dcat", "a", modified, "<rdf/>")
+
+    assert record_cache.get_record("dcat", "a", modified) == "<rdf/>"
+    assert record_cache.get_record("rdf", "a", modified) is None
+    assert (
+        record_cache.get_record("dcat", "a", modified.replace(second=1))
+        is None
+    )
+
+    record_cache.discard("a")
+    assert record_cache.get_record("dcat", "a", modified) is None
+
+
+def test_failed_enqueue_does_not_block_later_jobs(backend):
+    store, queue = backend
+
+    queue.fail = True
+    record_cache.schedule_render("a")
+    assert queue.jobs == 0
+
+    queue.fail = False
+    record_cache.schedule_render("b")
+    assert queue.jobs == 1
+    assert set(store.pop_pending()) == {"a", "b"}
+
+
+def test_uncommitted_changes_are_retried_with_backoff(backend, monkeypatch):
+    _, queue = backend
+    rendered, delays = [], []
+    # Committed after the second attempt
+    monkeypatch.setattr(
+        record_cache,
+        "render_dataset",
+        lambda id, stamp: rendered.append(id) or len(rendered) > 2,
+    )
+    monkeypatch.setattr(record_cache.time, "sleep", delays.append)
+
+    record_cache.schedule_render("a", datetime.utcnow())
+    record_cache.render_pending_records()
+
+    assert rendered == ["a", "a", "a"]
+    assert delays == [1, 2]
+    # Retries do not queue new jobs
+    assert queue.jobs == 1
+
+
+def test_rolled_back_changes_are_given_up(backend, monkeypatch):
+    rendered, delays = [], []
+    monkeypatch.setattr(
+        record_cache,
+        "render_dataset",
+        lambda id, stamp: rendered.append(id) or False,
+    )
+    monkeypatch.setattr(record_cache.time, "sleep", delays.append)
+
+    record_cache.schedule_render("a", datetime.utcnow())
+    record_cache.render_pending_records()
+
+    assert delays == list(record_cache.RENDER_RETRY_DELAYS)
+    assert len(rendered) == len(record_cache.RENDER_RETRY_DELAYS) + 1
+
+
+def test_is_committed():
+    from types import SimpleNamespace
+
+    saved = datetime(2023, 1, 1, 10, 0, 0, 500)
+    stamp = record_cache.get_stamp(saved)
+
+    older = SimpleNamespace(metadata_modified=saved - timedelta(seconds=1))
+    assert not record_cache._is_committed(older, stamp)
+    current = SimpleNamespace(metadata_modified=saved)
+    assert record_cache._is_committed(current, stamp)
+    assert record_cache._is_committed(older, None)
+
+
+def test_memory_store_evicts_least_recently_used_records():
+    store = record_cache.MemoryRecordStore(max_size=10)
+
+    store.set("dcat", "a", "1", "x" * 4)
+    store.set("dcat", "b", "1", "x" * 4)
+    assert store.get("dcat", "a", "1") is not None
+    store.set("dcat", "c", "1", "x" * 4)
+
+    assert store.get("dcat", "b", "1") is None
+    assert store.get("dcat", "a", "1") is not None
+    assert store.get("dcat", "c", "1") is not None
+
+
+def test_invalidate_drops_stored_records(backend):
+    modified = datetime(2023, 1, 1)
+    record_cache.store_record("dcat", "a", modified, "<rdf/>")
+
+    record_cache.invalidate()
+
+    assert record_cache.get_record("dcat", "a", modified) is None
+
+
+def test_redis_records_expire_and_follow_generation():
+    store = record_cache.RedisRecordStore(ttl=60)
+    key = store._key("test-dataset")
+    try:
+        store.set("dcat", "test-dataset", "1", "<rdf/>")
+        assert store.get("dcat", "test-dataset", "1") == "<rdf/>"
+        assert 0 < store._redis.ttl(key) <= 60
+
+        store.invalidate()
+
+        assert store.get("dcat", "test-dataset", "1") is None
+    finally:
+        store.discard("test-dataset")
+
+
+@pytest.mark.ckan_config("ckanext.oai_pmh_server.prerender.backend", "")
+def test_disabled_by_default():
+    assert record_cache.get_backend() is None
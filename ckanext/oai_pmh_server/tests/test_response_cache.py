@@ -0,0 +1,51 @@
+"""Tests for response_cache.py."""
+import gzip
+import os
+
+from ckanext.oai_pmh_server.response_cache import ResponseCache
+
+
+def test_entries_are_stored_compressed():
+    cache = ResponseCache(1024 * 1024)
+    response = b"<OAI-PMH>" + b"<record/>" * 1000 + b"</OAI-PMH>"
+
+    cache.set("key", response, 1000, 60)
+    entry = cache.get("key")
+
+    assert entry.records == 1000
+    assert len(entry.data) < len(response)
+    assert gzip.decompress(entry.data) == response
+    assert cache.get("other") is None
+
+
+def test_entries_expire(clock):
+    cache = ResponseCache(1024, clock=clock)
+
+    cache.set("key", b"<OAI-PMH/>", 1, 10)
+    clock.now = 9
+    assert cache.get("key") is not None
+    clock.now = 10
+    assert cache.get("key") is None
+
+
+def test_least_recently_used_entries_are_evicted():
+    # Random content does not compress: each entry takes ~400 bytes
+    responses = {key: os.urandom(400) for key in ("a", "b", "c")}
+    cache = ResponseCache(1000)
+
+    cache.set("a", responses["a"], 1, 60)
+    cache.set("b", responses["b"], 1, 60)
+    assert cache.get("a") is not None
+    cache.set("c", responses["c"], 1, 60)
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_oversized_responses_are_not_cached():
+    cache = ResponseCache(100)
+
+    cache.set("key", os.urandom(1000), 1, 60)
+
+    assert cache.get("key") is None
@@ -0,0 +1,59 @@
+"""Tests for set_catalog.py."""
+import pytest
+
+from ckan.tests import factories
+
+from ckanext.oai_pmh_server.set_catalog import set_catalog
+
+
+@pytest.fixture
+def catalog():
+    set_catalog.invalidate()
+    yield set_catalog
+    set_catalog.invalidate()
+
+
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+def test_catalog_resolves_sets(catalog):
+    org = factories.Organization(name="org-a")
+    group = factories.Group(name="group-b")
+
+    entry = catalog.get("org-a")
+    assert entry.id == org["id"]
+    assert entry.type == "organization"
+    assert catalog.get("group-b").id == group["id"]
+    assert catalog.get("missing") is None
+
+
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+def test_catalog_pages_are_sorted_by_spec(catalog):
+    for name in ("org-c", "org-a", "org-b"):
+        factories.Organization(name=name)
+
+    entries, total = catalog.page(1, 2)
+
+    assert total == 3
+    assert [entry.name for entry in entries] == ["org-b", "org-c"]
+
+
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+def test_catalog_is_refreshed_on_group_changes(catalog):
+    factories.Organization(name="org-a")
+    assert catalog.get("org-new") is None
+
+    factories.Organization(name="org-new")
+
+    assert catalog.get("org-new") is not None
+
+
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+def test_catalog_falls_back_to_database(catalog, monkeypatch):
+    factories.Organization(name="org-a")
+    assert catalog.get("org-a") is not None
+
+    # As if created by another worker: the hooks do not drop this catalog
+    with monkeypatch.context() as m:
+        m.setattr(catalog, "invalidate", lambda: None)
+        org = factories.Organization(name="org-other")
+
+    assert catalog.get("org-other").id == org["id"]
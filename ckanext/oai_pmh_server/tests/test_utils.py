@@ -0,0 +1,54 @@
+"""Tests for external/utils.py."""
+import timeit
+
+import pytest
+from iso639 import languages
+
+from ckanext.oai_pmh_server.external import utils
+
+# Upper bound of the table build time, relative to reading the iso639 lists it
+# is built from (measured in the same run, so independent of the machine)
+LANGUAGE_TABLE_BUILD_RATIO = 3
+
+
+def test_convert_language():
+    assert utils.convert_language("en") == "eng"
+    assert utils.convert_language("de") == "deu"
+    assert utils.convert_language("ger") == "deu"
+    assert utils.convert_language("") == "und"
+    assert utils.convert_language(None) == "und"
+    assert utils.convert_language("not-a-language") == ""
+
+
+def test_convert_language_matches_iso639():
+    for code, lang in languages.part1.items():
+        assert utils.convert_language(code) == lang.terminology
+
+
+def test_convert_languages():
+    assert utils.convert_languages(["en", "es", "xx"]) == ["eng", "spa", ""]
+
+
+def test_language_table_is_immutable():
+    with pytest.raises(TypeError):
+        utils.LANGUAGE_TABLE["en"] = "xxx"
+    assert utils.LANGUAGE_TABLE["en"] == "eng"
+
+
+def test_language_table_build_time():
+    """Building the table at import must cost about as much as reading the
+    iso639 lists, which are loaded on first access (already done here)."""
+
+    def read_lists():
+        for lang in languages.part2b.values():
+            lang.terminology
+        for lang in languages.part1.values():
+            lang.terminology
+
+    # Best of many runs, so the ratio is not skewed by noise (~1.1 measured)
+    build = min(
+        timeit.repeat(utils._build_language_table, number=10, repeat=20)
+    )
+    read = min(timeit.repeat(read_lists, number=10, repeat=20))
+
+    assert build < LANGUAGE_TABLE_BUILD_RATIO * read